@@ -10,20 +10,46 @@ The script is intentionally conservative:
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
 import csv
+import functools
 import json
+import operator
+import re
 import shutil
 import subprocess
 import sys
+import tempfile
 import unicodedata
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Tuple
 
+from sqlalchemy import and_
+from sqlalchemy.orm import load_only
+
 from pyrekordbox import Rekordbox6Database
 from pyrekordbox.db6 import tables
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover - optional speedup
+    _json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover - optional speedup
+    ijson = None
+
+try:
+    from rapidfuzz import fuzz as _rf_fuzz
+    from rapidfuzz import process as _rf_process
+except ImportError:  # pragma: no cover - optional fuzzy fallback
+    _rf_process = None
+
 
 @dataclass(frozen=True)
 class LikeEntry:
@@ -44,6 +70,7 @@ class Match:
     sc_url: str
     match_mode: str
     old_created_at: Optional[datetime]
+    match_score: float = 100.0
     new_created_at: Optional[datetime] = None
 
 
@@ -54,28 +81,46 @@ class Unmatched:
     reason: str
 
 
+_WS_RE = re.compile(r"\s+")
+# Punctuation variants common in music titles, folded in one C-level pass.
+# Chained .replace calls would rescan the string once per mapping.
+_PUNCT_TRANS = str.maketrans(
+    {
+        "：": ":",
+        "–": "-",
+        "—": "-",
+        "‘": "'",
+        "’": "'",
+        "“": '"',
+        "”": '"',
+    }
+)
+_ANCHOR_DT_RE = re.compile(
+    r"^(\d{4})-(\d{1,2})-(\d{1,2})[T ](\d{1,2}):(\d{1,2})(?::(\d{1,2}))?$"
+)
+
+
+@functools.lru_cache(maxsize=None)
 def normalize_title(raw: str) -> str:
+    # Pure function over small strings; cached because local titles and
+    # basename stems frequently coincide, so repeats are the common case.
     text = unicodedata.normalize("NFKC", raw or "")
-    text = text.replace("：", ":")
-    text = " ".join(text.lower().strip().split())
-    return text
+    text = text.translate(_PUNCT_TRANS)
+    return _WS_RE.sub(" ", text.casefold()).strip()
 
 
 def parse_anchor_datetime(raw: str) -> datetime:
-    candidates = [
-        "%Y-%m-%dT%H:%M:%S",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y-%m-%dT%H:%M",
-        "%Y-%m-%d %H:%M",
-    ]
-    for fmt in candidates:
-        try:
-            return datetime.strptime(raw, fmt)
-        except ValueError:
-            continue
-    raise ValueError(
-        "Invalid --anchor-datetime format. Use one of: "
-        "YYYY-MM-DDTHH:MM:SS, YYYY-MM-DD HH:MM:SS, YYYY-MM-DDTHH:MM, YYYY-MM-DD HH:MM"
+    # One regex pass covers all four accepted layouts (T or space separator,
+    # optional seconds) instead of up to four strptime attempts.
+    m = _ANCHOR_DT_RE.match(raw)
+    if not m:
+        raise ValueError(
+            "Invalid --anchor-datetime format. Use one of: "
+            "YYYY-MM-DDTHH:MM:SS, YYYY-MM-DD HH:MM:SS, YYYY-MM-DDTHH:MM, YYYY-MM-DD HH:MM"
+        )
+    year, month, day, hour, minute, second = m.groups()
+    return datetime(
+        int(year), int(month), int(day), int(hour), int(minute), int(second or 0)
     )
 
 
@@ -94,23 +139,77 @@ def require_cmd(name: str) -> None:
     raise RuntimeError(f"Missing required command: {name}")
 
 
-def fetch_likes(likes_url: str) -> List[LikeEntry]:
-    require_cmd("yt-dlp")
-    cmd = ["yt-dlp", "--flat-playlist", "-J", likes_url]
-    proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+def _iter_playlist_entries(cmd: List[str], likes_url: str) -> Iterable[dict]:
+    # With ijson available, stream entries out of the yt-dlp pipe as they are
+    # emitted instead of buffering the whole JSON document first: memory stays
+    # O(1) in playlist size and entry processing overlaps the fetch. Without
+    # ijson, fall back to the buffered one-shot parse.
+    if ijson is not None:
+        # Spool stderr to an unlinked temp file: yt-dlp logs per-page
+        # extraction lines there with -J, and a stderr pipe we only drain
+        # after stdout EOF would deadlock once those lines fill the pipe
+        # buffer.
+        with tempfile.TemporaryFile() as stderr_file:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+
+            def read_stderr() -> str:
+                stderr_file.seek(0)
+                return stderr_file.read().decode("utf-8", errors="replace").strip()
+
+            try:
+                yield from ijson.items(proc.stdout, "entries.item")
+            except ijson.JSONError as exc:
+                # A truncated stream usually means yt-dlp died; prefer its
+                # returncode and stderr diagnostics over the parse error.
+                still_running = proc.poll() is None
+                if still_running:
+                    proc.kill()
+                proc.wait()
+                if not still_running and proc.returncode != 0:
+                    raise RuntimeError(
+                        f"yt-dlp failed ({proc.returncode}) while fetching likes URL "
+                        f"'{likes_url}'.\nstderr: {read_stderr()}"
+                    ) from exc
+                raise RuntimeError(f"Failed to parse yt-dlp JSON output: {exc}") from exc
+            proc.wait()
+            if proc.returncode != 0:
+                raise RuntimeError(
+                    f"yt-dlp failed ({proc.returncode}) while fetching likes URL "
+                    f"'{likes_url}'.\nstderr: {read_stderr()}"
+                )
+        return
+
+    # Keep stdout as bytes: orjson decodes UTF-8 itself, so text=True would
+    # just add a redundant decode pass over a potentially multi-MB payload.
+    proc = subprocess.run(cmd, capture_output=True, check=False)
     if proc.returncode != 0:
+        stderr = proc.stderr.decode("utf-8", errors="replace").strip()
         raise RuntimeError(
             f"yt-dlp failed ({proc.returncode}) while fetching likes URL '{likes_url}'.\n"
-            f"stderr: {proc.stderr.strip()}"
+            f"stderr: {stderr}"
         )
     try:
-        payload = json.loads(proc.stdout)
-    except json.JSONDecodeError as exc:
+        payload = _json_loads(proc.stdout)
+    except ValueError as exc:
         raise RuntimeError(f"Failed to parse yt-dlp JSON output: {exc}") from exc
+    yield from payload.get("entries") or []
 
-    entries = payload.get("entries") or []
+
+def fetch_likes(likes_url: str) -> Tuple[List[LikeEntry], Dict[str, Tuple[LikeEntry, str]]]:
+    """Fetch likes and build the title lookup index in the same pass.
+
+    The index is keyed by both exact and normalized titles, with the match
+    mode stored alongside the entry so a probe resolves both in one dict
+    access. Exact titles win key collisions, so they go straight into the
+    index while normalized forms are staged and merged after the loop; the
+    entry stream is still traversed only once.
+    """
+    require_cmd("yt-dlp")
+    cmd = ["yt-dlp", "--flat-playlist", "-J", likes_url]
     likes: List[LikeEntry] = []
-    for i, entry in enumerate(entries, start=1):
+    index: Dict[str, Tuple[LikeEntry, str]] = {}
+    norms: Dict[str, Tuple[LikeEntry, str]] = {}
+    for i, entry in enumerate(_iter_playlist_entries(cmd, likes_url), start=1):
         if not entry:
             continue
         title = (entry.get("title") or "").strip()
@@ -118,59 +217,81 @@ def fetch_likes(likes_url: str) -> List[LikeEntry]:
             continue
         sc_id = str(entry.get("id") or "")
         url = str(entry.get("url") or entry.get("webpage_url") or "")
-        likes.append(LikeEntry(index=i, sc_id=sc_id, title=title, url=url))
+        item = LikeEntry(index=i, sc_id=sc_id, title=title, url=url)
+        likes.append(item)
+        index.setdefault(title, (item, "exact"))
+        norm = normalize_title(title)
+        if norm:
+            norms.setdefault(norm, (item, "normalized"))
     if not likes:
         raise RuntimeError(f"No likes entries found at: {likes_url}")
-    return likes
+    for key, value in norms.items():
+        index.setdefault(key, value)
+    return likes, index
 
 
-def build_likes_maps(
-    likes: Iterable[LikeEntry],
-) -> Tuple[Dict[str, LikeEntry], Dict[str, LikeEntry]]:
-    by_exact: Dict[str, LikeEntry] = {}
-    by_norm: Dict[str, LikeEntry] = {}
-    for item in likes:
-        by_exact.setdefault(item.title, item)
-        norm = normalize_title(item.title)
-        if norm:
-            by_norm.setdefault(norm, item)
-    return by_exact, by_norm
+def path_stem(file_path: str) -> str:
+    # Pure-string equivalent of Path(file_path).stem; avoids constructing a
+    # Path object (and its parsing) for every row in the matching loop.
+    tail = file_path.rpartition("/")[2]
+    return tail.rsplit(".", 1)[0] if "." in tail else tail
 
 
 def find_local_title(row: tables.DjmdContent) -> str:
     if row.Title:
         return str(row.Title)
-    path = Path(str(row.FolderPath))
-    return path.stem
+    return path_stem(str(row.FolderPath))
 
 
 def match_rows_to_likes(
-    rows: Iterable[tables.DjmdContent], by_exact: Dict[str, LikeEntry], by_norm: Dict[str, LikeEntry]
+    rows: Iterable[tables.DjmdContent],
+    index: Dict[str, Tuple[LikeEntry, str]],
+    fuzzy_norms: Optional[Dict[str, LikeEntry]] = None,
 ) -> Tuple[List[Match], List[Unmatched]]:
     matched: List[Match] = []
     unmatched: List[Unmatched] = []
     for row in rows:
         file_path = str(row.FolderPath)
         local_title = find_local_title(row)
-        basename_stem = Path(file_path).stem
+        basename_stem = path_stem(file_path)
 
-        candidates = [local_title, basename_stem]
         item: Optional[LikeEntry] = None
         mode = ""
-
-        for candidate in candidates:
-            if candidate in by_exact:
-                item = by_exact[candidate]
-                mode = "exact"
+        score = 100.0
+
+        # Probe cheapest keys first: exact titles, then normalized forms.
+        # A like whose title is already in normalized form carries an
+        # exact-tagged key equal to its normalized key, so a hit from a
+        # normalized probe must be reported as "normalized" regardless of
+        # the key's tag.
+        for probe_is_norm, key in (
+            (False, local_title),
+            (False, basename_stem),
+            (True, normalize_title(local_title)),
+            (True, normalize_title(basename_stem)),
+        ):
+            hit = index.get(key) if key else None
+            if hit is not None:
+                item, mode = hit
+                if probe_is_norm:
+                    mode = "normalized"
                 break
 
-        if item is None:
-            for candidate in candidates:
-                norm = normalize_title(candidate)
-                if norm and norm in by_norm:
-                    item = by_norm[norm]
-                    mode = "normalized"
-                    break
+        if item is None and fuzzy_norms:
+            # Tertiary fallback: rapidfuzz top-1 over the normalized like
+            # titles, accepted only above the cutoff so dry-run plans stay
+            # reviewable.
+            norm_local = normalize_title(local_title)
+            best = _rf_process.extractOne(
+                norm_local,
+                fuzzy_norms.keys(),
+                scorer=_rf_fuzz.WRatio,
+                score_cutoff=85,
+            )
+            if best is not None:
+                best_key, score, _ = best
+                item = fuzzy_norms[best_key]
+                mode = "fuzzy"
 
         if item is None:
             unmatched.append(
@@ -189,6 +310,7 @@ def match_rows_to_likes(
                 sc_url=item.url,
                 match_mode=mode,
                 old_created_at=row.created_at,
+                match_score=score,
             )
         )
     return matched, unmatched
@@ -199,14 +321,20 @@ def write_tsv(path: Path, header: List[str], rows: Iterable[List[str]]) -> None:
     with path.open("w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f, delimiter="\t")
         writer.writerow(header)
-        for row in rows:
-            writer.writerow(row)
+        # writerows consumes any iterable in a single C loop, so callers can
+        # pass generators and rows are formatted and flushed one at a time.
+        writer.writerows(rows)
 
 
 def format_dt(dt: Optional[datetime]) -> str:
     if dt is None:
         return ""
-    return dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+    # Equivalent to strftime("%Y-%m-%d %H:%M:%S.%f") but skips the format
+    # string parsing; called up to five times per matched row across the TSVs.
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} "
+        f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}.{dt.microsecond:06d}"
+    )
 
 
 def main(argv: Optional[List[str]] = None) -> int:
@@ -238,6 +366,12 @@ def main(argv: Optional[List[str]] = None) -> int:
         default="",
         help="Directory for run manifests (default: <script-dir>/runs)",
     )
+    parser.add_argument(
+        "--fuzzy",
+        action="store_true",
+        help="Enable rapidfuzz fallback matching (WRatio >= 85) for rows that miss "
+        "both exact and normalized lookups. Requires the rapidfuzz package.",
+    )
     parser.add_argument(
         "--apply",
         action="store_true",
@@ -252,7 +386,8 @@ def main(argv: Optional[List[str]] = None) -> int:
         if args.run_root
         else (Path(__file__).resolve().parent / "runs")
     )
-    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    started_at = datetime.now()
+    run_id = started_at.strftime("%Y%m%d-%H%M%S")
     run_dir = run_root / run_id
     run_dir.mkdir(parents=True, exist_ok=True)
 
@@ -266,6 +401,9 @@ def main(argv: Optional[List[str]] = None) -> int:
     if args.step_seconds < 1:
         print("--step-seconds must be >= 1", file=sys.stderr)
         return 2
+    if args.fuzzy and _rf_process is None:
+        print("--fuzzy requires the rapidfuzz package (pip install rapidfuzz)", file=sys.stderr)
+        return 2
 
     db_path = db_dir / "master.db"
     if not db_path.exists():
@@ -275,29 +413,66 @@ def main(argv: Optional[List[str]] = None) -> int:
         print(f"target-dir does not exist: {target_dir}", file=sys.stderr)
         return 2
 
+    # The likes fetch blocks on yt-dlp while opening the Rekordbox DB (key
+    # lookup, SQLCipher setup) is pure local I/O; run the fetch in a worker
+    # thread so the two latencies overlap. Matching consumes the fetched
+    # index, so row iteration starts only after the join.
     print("Fetching SoundCloud likes order...")
-    likes = fetch_likes(args.likes_url)
-    by_exact, by_norm = build_likes_maps(likes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        likes_future = pool.submit(fetch_likes, args.likes_url)
+        print("Opening Rekordbox DB...")
+        db = Rekordbox6Database(path=db_path, db_dir=db_dir)
+        likes, likes_index = likes_future.result()
+
+    fuzzy_norms: Optional[Dict[str, LikeEntry]] = None
+    if args.fuzzy:
+        fuzzy_norms = {}
+        for x in likes:
+            norm = normalize_title(x.title)
+            if norm:
+                fuzzy_norms.setdefault(norm, x)
+
     write_tsv(
         likes_tsv,
         ["sc_index", "sc_id", "sc_title", "sc_url"],
-        [[str(x.index), x.sc_id, x.title, x.url] for x in likes],
+        ([str(x.index), x.sc_id, x.title, x.url] for x in likes),
     )
-
-    print("Opening Rekordbox DB...")
-    db = Rekordbox6Database(path=db_path, db_dir=db_dir)
     target_prefix = f"{target_dir}/"
+    # Stream rows in batches instead of materializing the whole result set;
+    # match_rows_to_likes only needs one row at a time.
+    # LIKE 'prefix%' keeps the baseline prefix semantics; the half-open range
+    # alongside it lets SQLite bracket the scan with a plain btree index on
+    # FolderPath. The upper bound increments the trailing '/' to '0' (the
+    # next byte), which covers every continuation including 4-byte UTF-8
+    # characters that would sort above a U+FFFF sentinel.
+    prefix_predicate = and_(
+        tables.DjmdContent.FolderPath.like(f"{target_prefix}%"),
+        tables.DjmdContent.FolderPath >= target_prefix,
+        tables.DjmdContent.FolderPath < target_prefix[:-1] + "0",
+    )
+    # Matching only touches these columns; skip hydrating the rest of the
+    # wide djmdContent row.
+    needed_cols = load_only(
+        tables.DjmdContent.ID,
+        tables.DjmdContent.Title,
+        tables.DjmdContent.FolderPath,
+        tables.DjmdContent.created_at,
+    )
     rows = (
         db.get_content()
-        .filter(tables.DjmdContent.FolderPath.like(f"{target_prefix}%"))
-        .all()
+        .options(needed_cols)
+        .filter(prefix_predicate)
+        .yield_per(1000)
+        .enable_eagerloads(False)
     )
-    if not rows:
+
+    matched, unmatched = match_rows_to_likes(rows, likes_index, fuzzy_norms)
+    # Every downstream consumer wants sc_index order; sort once, in place.
+    matched.sort(key=operator.attrgetter("sc_index"))
+    if not matched and not unmatched:
         db.close()
         print(f"No djmdContent rows found under target-dir prefix: {target_prefix}", file=sys.stderr)
         return 3
-
-    matched, unmatched = match_rows_to_likes(rows, by_exact, by_norm)
     write_tsv(
         matched_tsv,
         [
@@ -307,9 +482,10 @@ def main(argv: Optional[List[str]] = None) -> int:
             "sc_id",
             "sc_title",
             "match_mode",
+            "match_score",
             "old_created_at",
         ],
-        [
+        (
             [
                 m.file_path,
                 m.local_title,
@@ -317,15 +493,16 @@ def main(argv: Optional[List[str]] = None) -> int:
                 m.sc_id,
                 m.sc_title,
                 m.match_mode,
+                f"{m.match_score:.1f}",
                 format_dt(m.old_created_at),
             ]
-            for m in sorted(matched, key=lambda x: x.sc_index)
-        ],
+            for m in matched
+        ),
     )
     write_tsv(
         unmatched_tsv,
         ["file_path", "local_title", "reason"],
-        [[u.file_path, u.local_title, u.reason] for u in unmatched],
+        ([u.file_path, u.local_title, u.reason] for u in unmatched),
     )
 
     if not matched:
@@ -341,13 +518,23 @@ def main(argv: Optional[List[str]] = None) -> int:
             anchor = datetime.now()
     anchor = ensure_millis_precision(anchor)
 
-    matched_sorted = sorted(matched, key=lambda x: x.sc_index)
-    for pos, m in enumerate(matched_sorted):
-        if args.use_like_index_offset:
-            offset_steps = m.sc_index - 1
-        else:
-            offset_steps = pos
-        m.new_created_at = ensure_millis_precision(anchor - timedelta(seconds=offset_steps * args.step_seconds))
+    # Build the step once; anchor already carries non-zero microseconds, so
+    # subtracting whole seconds keeps ensure_millis_precision a no-op and the
+    # dense case degenerates to one subtraction per row.
+    step = timedelta(seconds=args.step_seconds)
+    if args.use_like_index_offset:
+        for m in matched:
+            m.new_created_at = ensure_millis_precision(anchor - step * (m.sc_index - 1))
+    else:
+        current = anchor
+        for m in matched:
+            m.new_created_at = ensure_millis_precision(current)
+            current -= step
+
+    # Assign through the instrumented attribute: dry runs stay ORM-side (no
+    # SQL, no write lock) until commit/rollback, and pyrekordbox's
+    # commit(autoinc=True) USN bookkeeping sees the modified rows.
+    for m in matched:
         m.row.created_at = m.new_created_at
 
     write_tsv(
@@ -360,7 +547,7 @@ def main(argv: Optional[List[str]] = None) -> int:
             "new_created_at",
             "match_mode",
         ],
-        [
+        (
             [
                 m.file_path,
                 m.local_title,
@@ -369,23 +556,29 @@ def main(argv: Optional[List[str]] = None) -> int:
                 format_dt(m.new_created_at),
                 m.match_mode,
             ]
-            for m in matched_sorted
-        ],
+            for m in matched
+        ),
     )
 
-    with run_meta_path.open("w", encoding="utf-8") as f:
-        f.write(f"run_id={run_id}\n")
-        f.write(f"db_dir={db_dir}\n")
-        f.write(f"db_path={db_path}\n")
-        f.write(f"target_dir={target_dir}\n")
-        f.write(f"likes_url={args.likes_url}\n")
-        f.write(f"step_seconds={args.step_seconds}\n")
-        f.write(f"use_like_index_offset={int(bool(args.use_like_index_offset))}\n")
-        f.write(f"anchor_datetime={format_dt(anchor)}\n")
-        f.write(f"apply={int(bool(args.apply))}\n")
-        f.write(f"matched={len(matched)}\n")
-        f.write(f"unmatched={len(unmatched)}\n")
-        f.write(f"started_at={datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    run_meta_path.write_text(
+        "".join(
+            [
+                f"run_id={run_id}\n",
+                f"db_dir={db_dir}\n",
+                f"db_path={db_path}\n",
+                f"target_dir={target_dir}\n",
+                f"likes_url={args.likes_url}\n",
+                f"step_seconds={args.step_seconds}\n",
+                f"use_like_index_offset={int(bool(args.use_like_index_offset))}\n",
+                f"anchor_datetime={format_dt(anchor)}\n",
+                f"apply={int(bool(args.apply))}\n",
+                f"matched={len(matched)}\n",
+                f"unmatched={len(unmatched)}\n",
+                f"started_at={started_at.strftime('%Y-%m-%d %H:%M:%S')}\n",
+            ]
+        ),
+        encoding="utf-8",
+    )
 
     if args.apply:
         print("Applying changes to master.db...")
@@ -403,27 +596,24 @@ def main(argv: Optional[List[str]] = None) -> int:
     else:
         db.rollback()
 
-    # Re-read to capture final stored values (including timezone-normalized strings)
-    rows_after = (
-        db.get_content()
-        .filter(tables.DjmdContent.FolderPath.like(f"{target_prefix}%"))
-        .all()
-    )
-    by_path = {str(r.FolderPath): r for r in rows_after}
+    # The matched ORM rows were modified through their instrumented
+    # attributes, so created_at here is the committed value. After a dry-run
+    # rollback the session expires the instances and each access reloads the
+    # old value by primary key — at most N single-row lookups, replacing the
+    # full second SELECT under target_prefix.
     write_tsv(
         applied_tsv,
         ["file_path", "local_title", "sc_index", "new_created_at_planned", "created_at_in_db"],
-        [
+        (
             [
                 m.file_path,
                 m.local_title,
                 str(m.sc_index),
                 format_dt(m.new_created_at),
-                format_dt(by_path[m.file_path].created_at),
+                format_dt(m.row.created_at),
             ]
-            for m in matched_sorted
-            if m.file_path in by_path
-        ],
+            for m in matched
+        ),
     )
 
     db.close()